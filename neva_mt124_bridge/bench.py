@@ -0,0 +1,263 @@
+"""Micro-benchmark and fuzz harness for the protocol parsers in run.py.
+
+Usage:
+    python3 neva_mt124_bridge/bench.py                 # compare against bench_baseline.json
+    python3 neva_mt124_bridge/bench.py --save          # record the baseline for this Python
+    python3 neva_mt124_bridge/bench.py --check         # check decoded values of the fixtures
+    python3 neva_mt124_bridge/bench.py --fuzz 20000    # fuzz parsers with corrupted frames
+
+bench_baseline.json is committed and holds allocations per call, keyed by
+Python minor version; only those gate the exit status. ops/sec is shown
+for information, it is host-specific and too noisy to fail on. Not part
+of the add-on image; needs the same Python packages as run.py.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def make_frame(payload):
+    # STX <payload> ETX <CRC>, как отвечает счётчик (без бита чётности)
+    frame = bytearray([run.STX]) + payload + bytearray([run.ETX, 0])
+    frame[-1] = run.checksum(frame)
+    return frame
+
+
+def add_parity(data):
+    return bytearray(b | 0x80 if run.check_even_parity(b) else b for b in data)
+
+
+FRAMES = {
+    'tariffs_6102': make_frame(b'0F0880FF(012345.67,006000.12,004000.55,002345.00,000000.00)'),
+    'tariffs_7109': make_frame(b'0F0880FF(S)[1]006000.12,004000.55,002345.00,000000.00)'),
+    'power': make_frame(b'100700FF(00123.456)'),
+    'volts': make_frame(b'0C0700FF(229.87)'),
+    'sensors': make_frame(b'600500FF(1,3.05)'),
+    'serial': make_frame(b'600100FF(01234567)'),
+}
+
+# Что отдаёт порт: мусор перед STX и биты чётности
+RAW_TARIFFS = add_parity(b'\x06\x00' + FRAMES['tariffs_6102'])
+
+
+def receive(raw):
+    return run.find_frame(raw.translate(run.PARITY_MASK))
+
+
+CASES = {
+    'checksum': (run.checksum, FRAMES['tariffs_6102']),
+    'check_even_parity': (lambda data: [run.check_even_parity(b) for b in data], FRAMES['tariffs_6102']),
+    'str2uint': (run.str2uint, '0123456789'),
+    'number_from_brackets': (run.number_from_brackets, FRAMES['power']),
+    'number_from_tariffs': (run.number_from_tariffs, b'006000.12,004000.55)'),
+    'parse_tariffs_6102': (run.parse_tariffs_6102, FRAMES['tariffs_6102']),
+    'parse_tariffs_7109': (run.parse_tariffs_7109, FRAMES['tariffs_7109']),
+    'find_frame': (run.find_frame, FRAMES['tariffs_6102']),
+    'receive_frame': (receive, RAW_TARIFFS),
+}
+
+# Ожидаемые значения для фикстур: (описание, вызов, результат)
+GOLDEN = [
+    ('parse_tariffs_6102', lambda: run.parse_tariffs_6102(FRAMES['tariffs_6102']),
+     {'energy_divisor': 100, 'tariff_summ': 1234567, 'tariff1': 600012,
+      'tariff2': 400055, 'tariff3': 234500, 'tariff4': 0}),
+    ('parse_tariffs_7109', lambda: run.parse_tariffs_7109(FRAMES['tariffs_7109']),
+     {'energy_divisor': 100, 'tariff_summ': 1234567, 'tariff1': 600012,
+      'tariff2': 400055, 'tariff3': 234500, 'tariff4': 0}),
+    ('number_from_brackets(power)', lambda: (run.number_from_brackets(FRAMES['power']), run.divisor), (123456, 1000)),
+    ('number_from_brackets(volts)', lambda: (run.number_from_brackets(FRAMES['volts']), run.divisor), (22987, 100)),
+    ('number_from_tariffs', lambda: run.number_from_tariffs(b'006000.12,004000.55)'), (600012, 10)),
+    ('str_from_brackets(serial)', lambda: run.str_from_brackets(FRAMES['serial']), '01234567'),
+    ('parse_resbat', lambda: run.parse_resbat(FRAMES['sensors']), 94),
+    ('str2uint', lambda: run.str2uint('0123456789x1'), 123456789),
+    ('receive_frame', lambda: bytes(receive(RAW_TARIFFS)), bytes(FRAMES['tariffs_6102'])),
+] + [
+    (f'find_frame({name})', lambda frame=frame: bytes(run.find_frame(b'\x06' + frame)), bytes(frame))
+    for name, frame in FRAMES.items()
+]
+
+PARSERS = [
+    run.checksum,
+    run.number_from_brackets,
+    run.number_from_tariffs,
+    run.str_from_brackets,
+    run.parse_tariffs_6102,
+    run.parse_tariffs_7109,
+    run.parse_resbat,
+    run.find_frame,
+    receive,
+]
+
+
+def ops_per_sec(func, arg, min_time=0.2, repeat=3):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(arg)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    # Лучший из нескольких прогонов меньше зависит от шума планировщика
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(arg)
+        best = min(best, time.perf_counter() - start)
+    return number / best
+
+
+def alloc_bytes(func, arg):
+    # Пиковый объём памяти, выделенной за один вызов
+    func(arg)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        func(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - base
+
+
+def run_bench():
+    results = {}
+    for name, (func, arg) in CASES.items():
+        results[name] = {
+            'ops_per_sec': round(ops_per_sec(func, arg)),
+            'alloc_bytes': alloc_bytes(func, arg),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressed = False
+    print(f"{'case':<22} {'ops/sec':>12} {'alloc B':>8} {'baseline':>8}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        mark = ''
+        if base is not None and result['alloc_bytes'] > base * (1 + tolerance):
+            mark = '  REGRESSION'
+            regressed = True
+        print(f"{name:<22} {result['ops_per_sec']:>12} {result['alloc_bytes']:>8} "
+              f"{'-' if base is None else base:>8}{mark}")
+    return regressed
+
+
+def load_baselines():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def mutate(rng, frame):
+    data = bytearray(frame)
+    kind = rng.choice(('corrupt', 'truncate', 'parity', 'insert', 'delete', 'splice'))
+    if kind == 'corrupt':
+        data[rng.randrange(len(data))] = rng.randrange(256)
+    elif kind == 'truncate':
+        del data[rng.randrange(len(data)):]
+    elif kind == 'parity':
+        data = add_parity(data)
+        data[rng.randrange(len(data))] ^= 0x80
+    elif kind == 'insert':
+        pos = rng.randrange(len(data) + 1)
+        data[pos:pos] = bytes(rng.choice((run.STX, run.ETX, ord('('), ord(')'), ord(','), ord('.'), ord(']')))
+                              for _ in range(rng.randint(1, 4)))
+    elif kind == 'delete':
+        pos = rng.randrange(len(data))
+        del data[pos:pos + rng.randint(1, 8)]
+    else:
+        other = rng.choice(list(FRAMES.values()))
+        data = data[:rng.randrange(len(data) + 1)] + other[rng.randrange(len(other)):]
+    return kind, data
+
+
+def check_golden():
+    ok = True
+    for name, call, expected in GOLDEN:
+        try:
+            result = call()
+        except Exception as e:
+            result = e
+        if result != expected:
+            ok = False
+            print(f"{name}: expected {expected!r}, got {result!r}")
+    print(f"Checked {len(GOLDEN)} golden values: {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def run_fuzz(iterations, seed):
+    rng = random.Random(seed)
+    frames = list(FRAMES.values())
+    failures = 0
+    for i in range(iterations):
+        kind, data = mutate(rng, rng.choice(frames))
+        for func in PARSERS:
+            try:
+                result = func(data)
+            except Exception as e:
+                failures += 1
+                print(f"#{i} {kind}: {func.__name__}({bytes(data)!r}) raised {e!r}")
+                continue
+            # Найденный фрейм всегда начинается с STX и имеет верный CRC
+            if func in (run.find_frame, receive) and result is not None:
+                if result[0] != run.STX or run.checksum(result) != result[-1]:
+                    failures += 1
+                    print(f"#{i} {kind}: {func.__name__}({bytes(data)!r}) returned invalid frame {bytes(result)!r}")
+    print(f"Fuzzed {iterations} frames (seed {seed}): {failures} failures")
+    return failures == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', action='store_true', help='store allocations as the baseline for this Python version')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed allocation growth (0.2 = 20%%)')
+    parser.add_argument('--check', action='store_true', help='only check decoded values of the fixture frames')
+    parser.add_argument('--fuzz', type=int, metavar='N', help='fuzz parsers with N mutated frames instead of benchmarking')
+    parser.add_argument('--seed', type=int, default=0, help='fuzz RNG seed')
+    args = parser.parse_args()
+
+    # Отладочный вывод run.py искажает замеры
+    logging.disable(logging.CRITICAL)
+
+    if args.check:
+        return 0 if check_golden() else 1
+    if args.fuzz:
+        # Фаззинг имеет смысл только если парсеры верны на исходных фреймах
+        if not check_golden():
+            return 1
+        return 0 if run_fuzz(args.fuzz, args.seed) else 1
+
+    results = run_bench()
+    version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    baselines = load_baselines()
+    if args.save:
+        baselines[version] = {name: result['alloc_bytes'] for name, result in results.items()}
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline for Python {version} saved to {BASELINE_PATH}")
+    if version not in baselines:
+        compare(results, {}, args.tolerance)
+        print(f"No baseline for Python {version}: run with --save first")
+        return 1
+    return 1 if compare(results, baselines[version], args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,13 +3,27 @@ import paho.mqtt.client as mqtt
 import time
 import json
 import os
+import signal
 import sys
 import logging
+import abc
+import collections
+import csv
+import datetime
+import socket
+import threading
+import urllib.parse
+import urllib.request
 
 # Timezone will be set from config later
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-logging.debug("Script started - debugging mode")
+# Уровень логирования задаётся опцией log_level, до чтения опций — INFO
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.debug("Script started")
+
+# Отдельный канал для hex-дампов протокола, не зависит от log_level
+trace_log = logging.getLogger('neva_mt124.trace')
+trace_log.setLevel(logging.DEBUG)
 
 # Константы из C-кода
 ACK = 0x06
@@ -43,6 +57,69 @@ NEVA_124_UNKNOWN = 0
 NEVA_124_6102 = 1
 NEVA_124_7109 = 2
 
+# Таблица для снятия бита чётности (bytes.translate вместо генератора по байтам)
+PARITY_MASK = bytes(i & 0x7f for i in range(256))
+
+class ProtocolTrace:
+    """Protocol hex tracing, switched at runtime via MQTT.
+
+    Traces every command of the meter (`all`) or only selected commands, in
+    every `every`-th poll cycle. Disabled by default, so the hot path costs a
+    single attribute check.
+    """
+
+    def __init__(self):
+        self.all = False
+        self.commands = frozenset()
+        self.every = 1
+        self._cycle = 0
+        self._active = False
+
+    def configure(self, payload):
+        # payload: "off", "all", "cmd1,cmd2" или JSON {"commands": "off" | "all" | [...], "every": N}
+        payload = payload.strip()
+        every = 1
+        if payload.startswith('{'):
+            config = json.loads(payload)
+            if not isinstance(config, dict):
+                raise ValueError("expected a JSON object")
+            commands = config.get('commands', 'all')
+            every = config.get('every', 1)
+            if not isinstance(every, int) or isinstance(every, bool) or every < 1:
+                raise ValueError(f"'every' must be a positive integer, got {every!r}")
+        elif payload in ('', 'off'):
+            commands = []
+        else:
+            commands = payload
+        if isinstance(commands, str):
+            commands = [c.strip() for c in commands.split(',') if c.strip()]
+        # "off" выключает трассировку в обеих формах payload
+        if isinstance(commands, list) and commands in (['off'], []):
+            commands = []
+        if not isinstance(commands, list) or not all(isinstance(c, str) for c in commands):
+            raise ValueError("'commands' must be \"all\" or a list of command names")
+        unknown = [c for c in commands if c != 'all' and c not in COMMANDS]
+        if unknown:
+            raise ValueError(f"unknown commands: {', '.join(unknown)}")
+        self.every = every
+        self.commands = frozenset(c for c in commands if c != 'all')
+        self.all = 'all' in commands
+        logging.info("Protocol trace: %s, every %d cycle(s)",
+                     'all' if self.all else (', '.join(sorted(self.commands)) or 'off'), self.every)
+
+    def begin_cycle(self):
+        self._cycle += 1
+        self._active = (self.all or bool(self.commands)) and self._cycle % self.every == 0
+
+    def wants(self, cmd_key):
+        return self._active and (self.all or cmd_key in self.commands)
+
+protocol_trace = ProtocolTrace()
+
+def trace_bytes(cmd_key, label, data):
+    if protocol_trace.wants(cmd_key):
+        trace_log.debug("%s %s: %s", label, cmd_key, data.hex())
+
 # Функции из C (адаптированные)
 def checksum(data):
     crc = 0
@@ -56,6 +133,9 @@ def check_even_parity(ch):
     ch ^= ch >> 1
     return ch & 1
 
+# Таблица для установки бита чётности в командах
+EVEN_PARITY = bytes(b | 0x80 if check_even_parity(b) else b for b in range(256))
+
 def str2uint(s):
     num = 0
     for char in s:
@@ -96,7 +176,9 @@ def number_from_tariffs(p_str):
     global divisor, multiplier
     divisor = 1
     multiplier = 1
-    end = p_str.find(b',') if p_str.find(b',') != -1 else p_str.find(b')')
+    end = p_str.find(b',')
+    if end == -1:
+        end = p_str.find(b')')
     if end == -1:
         return None
     value_str = p_str[:end].decode(errors='ignore')
@@ -124,23 +206,50 @@ def str_from_brackets(p_str):
         return None
     return p_str[init_bracket:end_bracket].decode(errors='ignore')
 
+def tariffs_from_str(p_str, count):
+    # Список из count значений, разделённых ',', или None если фрейм обрезан
+    values = []
+    for _ in range(count):
+        parsed = number_from_tariffs(p_str)
+        if parsed is None:
+            return None
+        value, shift = parsed
+        values.append(value)
+        p_str = p_str[shift:]
+    return values
+
+def find_frame(data):
+    # Первый фрейм STX ... ETX <CRC> с верной контрольной суммой, иначе None
+    stx_idx = data.find(STX)
+    if stx_idx == -1:
+        return None
+    etx_pos = data.find(ETX, stx_idx)
+    # Нужен хотя бы один байт после ETX (контрольная сумма)
+    if etx_pos == -1 or len(data) <= etx_pos + 1:
+        return None
+    frame_data = data[stx_idx:etx_pos+2]  # Включаем ETX и CRC
+    crc = checksum(frame_data)
+    if crc != frame_data[-1]:
+        logging.debug("CRC mismatch: calculated %02x, received %02x", crc, frame_data[-1])
+        return None
+    if stx_idx > 0:
+        logging.debug("Dropping %d lead bytes before STX", stx_idx)
+    return frame_data
+
 def send_command(ser, cmd_key):
     cmd = COMMANDS[cmd_key]
     # Для начальной процедуры открытия канала и ACK старт используем "сырые" байты
     if cmd_key in ('open_channel', 'ack_start'):
         ser.write(cmd)
-        logging.debug(f"Sent {cmd_key} (raw): {cmd.hex()}")
+        logging.debug("Sent %s (raw)", cmd_key)
+        trace_bytes(cmd_key, "Sent (raw)", cmd)
         time.sleep(0.05)
         return len(cmd)
 
-    parity_cmd = bytearray()
-    for byte in cmd:
-        if check_even_parity(byte):
-            parity_cmd.append(byte | 0x80)
-        else:
-            parity_cmd.append(byte)
+    parity_cmd = cmd.translate(EVEN_PARITY)
     ser.write(parity_cmd)
-    logging.debug(f"Sent {cmd_key} (parity): {parity_cmd.hex()}")
+    logging.debug("Sent %s (parity)", cmd_key)
+    trace_bytes(cmd_key, "Sent (parity)", parity_cmd)
     time.sleep(0.05)
     return len(parity_cmd)
 
@@ -158,9 +267,10 @@ def response_meter(ser, cmd_key, timeout=1):
             time.sleep(0.01)
         if not data:
             return None, "Timeout"
-        data = bytearray(b & 0x7f for b in data)
+        trace_bytes(cmd_key, "Received", data)
+        data = data.translate(PARITY_MASK)
         if data[0] != ord('/'):
-            logging.debug(f"Raw data: {data.hex()}")
+            logging.debug("Invalid identification response, %d bytes", len(data))
             return None, "Invalid response"
         return data, "OK"
     
@@ -184,7 +294,8 @@ def response_meter(ser, cmd_key, timeout=1):
             ser.timeout = orig_timeout
         if not data:
             return None, "Timeout"
-        data = bytearray(b & 0x7f for b in data)
+        trace_bytes(cmd_key, "Received", data)
+        data = data.translate(PARITY_MASK)
         return data, "OK"
     
     # Общая ветка для протокольных команд со структурой (SOH ... ETX <CRC>)
@@ -194,34 +305,14 @@ def response_meter(ser, cmd_key, timeout=1):
             raw.extend(ser.read(ser.in_waiting))
         
         # Применяем маску parity к всему прочитанному буферу
-        data = bytearray(b & 0x7f for b in raw)
+        data = raw.translate(PARITY_MASK)
         
         # Проверим, есть ли в буфере полный фрейм (STX ... ETX <CRC>)
-        stx_idx = None
-        try:
-            stx_idx = data.index(STX)
-        except ValueError:
-            stx_idx = None
-
-        if stx_idx is not None:
-            # Найдем ETX после STX
-            try:
-                etx_pos = data.index(ETX, stx_idx)
-            except ValueError:
-                etx_pos = None
-                
-            # Если нашли ETX и есть хотя бы один байт после него (контрольная сумма), проверим CRC
-            if etx_pos is not None and len(data) > etx_pos + 1:
-                frame_data = data[stx_idx:etx_pos+2]  # Включаем ETX и CRC
-                crc = checksum(frame_data)
-                if crc == frame_data[-1]:
-                    # Удалим ведущие байты до STX, если они есть
-                    if stx_idx > 0:
-                        logging.debug(f"Dropping {stx_idx} lead bytes before STX: {data[:stx_idx].hex()}")
-                    return frame_data, "OK"
-                else:
-                    logging.debug(f"CRC mismatch: calculated {crc:02x}, received {frame_data[-1]:02x}")
-                    # Продолжаем читать, возможно фрейм еще не полный
+        frame_data = find_frame(data)
+        if frame_data is not None:
+            trace_bytes(cmd_key, "Received", raw)
+            return frame_data, "OK"
+        # Иначе продолжаем читать, возможно фрейм еще не полный
         
         time.sleep(0.01)
     
@@ -235,28 +326,13 @@ def response_meter(ser, cmd_key, timeout=1):
         extra = ser.read(64)
         if extra:
             raw.extend(extra)
-            data = bytearray(b & 0x7f for b in raw)
+            data = raw.translate(PARITY_MASK)
 
             # Повторим проверку на наличие полного фрейма
-            stx_idx = None
-            try:
-                stx_idx = data.index(STX)
-            except ValueError:
-                stx_idx = None
-
-            if stx_idx is not None:
-                try:
-                    etx_pos = data.index(ETX, stx_idx)
-                except ValueError:
-                    etx_pos = None
-
-                if etx_pos is not None and len(data) > etx_pos + 1:
-                    frame_data = data[stx_idx:etx_pos+2]  # Включаем ETX и CRC
-                    crc = checksum(frame_data)
-                    if crc == frame_data[-1]:
-                        if stx_idx > 0:
-                            logging.debug(f"Dropping {stx_idx} lead bytes before STX: {data[:stx_idx].hex()}")
-                        return frame_data, "OK"
+            frame_data = find_frame(data)
+            if frame_data is not None:
+                trace_bytes(cmd_key, "Received", raw)
+                return frame_data, "OK"
     finally:
         ser.timeout = orig_timeout
     
@@ -264,7 +340,8 @@ def response_meter(ser, cmd_key, timeout=1):
     if len(data) == 1 and data[0] == ACK:
         return data, "OK"
     
-    logging.debug(f"Incomplete frame: {data.hex()}")
+    logging.debug("Incomplete frame: %d bytes", len(data))
+    trace_bytes(cmd_key, "Incomplete", raw)
     return None, "Incomplete frame"
 
 # Основные функции get_*
@@ -281,9 +358,9 @@ def open_session(ser):
         dot_pos = data.find(b'.')
         if dot_pos != -1:
             type_str = data[dot_pos+1:dot_pos+5].decode(errors='ignore')
-            logging.debug(f"Parsed type string: '{type_str}'")
+            logging.debug("Parsed type string: '%s'", type_str)
             type_val = str2uint(type_str)
-            logging.debug(f"Parsed type value: {type_val}")
+            logging.debug("Parsed type value: %s", type_val)
             # Map known device type codes to internal types.
             # 2106 (NEVA MT113/MT124 test ID) uses same protocol as 6102 devices.
             # 7107 (NEVA MT124 variant) uses same protocol as 7109 devices.
@@ -300,7 +377,7 @@ def ack_start(ser, neva_type, main_baudrate=BAUDRATE_9600):
     time.sleep(0.2)  # meter switches baudrate ~200 ms after receiving 051
     ser.baudrate = main_baudrate
     data, err = response_meter(ser, 'ack_start', timeout=3)
-    logging.debug(f"ack_start response raw: {data.hex() if data else 'None'}, error: {err}")
+    logging.debug("ack_start response: %s, error: %s", data, err)
     if err == "OK":
         if neva_type == NEVA_124_6102:
             send_command(ser, 'password_6102')
@@ -313,33 +390,47 @@ def ack_start(ser, neva_type, main_baudrate=BAUDRATE_9600):
         return err == "OK"
     return False
 
+def parse_tariffs_6102(data):
+    bracket_pos = data.find(b'(')
+    if bracket_pos == -1:
+        return {}
+    values = tariffs_from_str(data[bracket_pos+1:], 5)
+    if values is None:
+        return {}
+    tariff_summ, tariff1, tariff2, tariff3, tariff4 = values
+    return {
+        'energy_divisor': divisor,
+        'tariff_summ': tariff_summ,
+        'tariff1': tariff1,
+        'tariff2': tariff2,
+        'tariff3': tariff3,
+        'tariff4': tariff4
+    }
+
+def parse_tariffs_7109(data):
+    bracket_pos = data.find(b']')
+    if bracket_pos == -1:
+        return {}
+    values = tariffs_from_str(data[bracket_pos+1:], 4)
+    if values is None:
+        return {}
+    tariff1, tariff2, tariff3, tariff4 = values
+    return {
+        'energy_divisor': divisor,
+        'tariff_summ': tariff1 + tariff2 + tariff3 + tariff4,
+        'tariff1': tariff1,
+        'tariff2': tariff2,
+        'tariff3': tariff3,
+        'tariff4': tariff4
+    }
+
 def get_tariffs_6102(ser):
     send_command(ser, 'tariffs_6102')
     data, err = response_meter(ser, 'tariffs_6102')
     logging.debug("Response: %s, error: %s", data, err)
     if err != "OK":
         return {}
-    bracket_pos = data.find(b'(')
-    if bracket_pos != -1:
-        p_str = data[bracket_pos:]
-        tariff_summ, shift = number_from_tariffs(p_str)
-        p_str = p_str[shift:]
-        tariff1, shift = number_from_tariffs(p_str)
-        p_str = p_str[shift:]
-        tariff2, shift = number_from_tariffs(p_str)
-        p_str = p_str[shift:]
-        tariff3, shift = number_from_tariffs(p_str)
-        p_str = p_str[shift:]
-        tariff4, _ = number_from_tariffs(p_str)
-        return {
-            'energy_divisor': divisor,
-            'tariff_summ': tariff_summ,
-            'tariff1': tariff1,
-            'tariff2': tariff2,
-            'tariff3': tariff3,
-            'tariff4': tariff4
-        }
-    return {}
+    return parse_tariffs_6102(data)
 
 # Аналогично для других get_* (tariffs_7109, power, volts, amps, serial, sensors для battery)
 def get_tariffs_7109(ser):
@@ -348,30 +439,7 @@ def get_tariffs_7109(ser):
     logging.debug("Response: %s, error: %s", data, err)
     if err != "OK":
         return {}
-    bracket_pos = data.find(b']')
-    if bracket_pos != -1:
-        p_str = data[bracket_pos+1:]
-        tariff_summ = 0
-        tariff1, shift = number_from_tariffs(p_str)
-        tariff_summ += tariff1
-        p_str = p_str[shift:]
-        tariff2, shift = number_from_tariffs(p_str)
-        tariff_summ += tariff2
-        p_str = p_str[shift:]
-        tariff3, shift = number_from_tariffs(p_str)
-        tariff_summ += tariff3
-        p_str = p_str[shift:]
-        tariff4, _ = number_from_tariffs(p_str)
-        tariff_summ += tariff4
-        return {
-            'energy_divisor': divisor,
-            'tariff_summ': tariff_summ,
-            'tariff1': tariff1,
-            'tariff2': tariff2,
-            'tariff3': tariff3,
-            'tariff4': tariff4
-        }
-    return {}
+    return parse_tariffs_7109(data)
 
 def get_power_data(ser, neva_type):
     send_command(ser, 'power_data')
@@ -430,18 +498,13 @@ def get_serial_number_data(ser):
         return None
     return str_from_brackets(data)
 
-def get_resbat_data(ser):
-    send_command(ser, 'sensors_data')
-    data, err = response_meter(ser, 'sensors_data')
-    logging.debug("Response: %s, error: %s", data, err)
-    if err != "OK":
-        return None
+def parse_resbat(data):
     bracket_pos = data.find(b'(')
     if bracket_pos != -1:
         p_str = data[bracket_pos+1:]
         comma_pos = p_str.find(b',')
         if comma_pos != -1:
-            p_str = p_str[comma_pos+1:]
+            p_str = p_str[comma_pos+1:].decode(errors='ignore')
             battery_mv = str2uint(p_str[:1]) * 1000 + str2uint(p_str[2:]) * 10  # Адаптировано
             if battery_mv < MIN_VBAT_MV:
                 battery_mv = MIN_VBAT_MV
@@ -451,9 +514,274 @@ def get_resbat_data(ser):
             return battery_level
     return None
 
+def get_resbat_data(ser):
+    send_command(ser, 'sensors_data')
+    data, err = response_meter(ser, 'sensors_data')
+    logging.debug("Response: %s, error: %s", data, err)
+    if err != "OK":
+        return None
+    return parse_resbat(data)
+
 def close_session(ser):
     send_command(ser, 'close_channel')
 
+# Экспорт показаний: опрос кладёт значения в очереди, приёмники (sinks)
+# отправляют их из своих потоков, не задерживая цикл опроса
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+# Поля одной записи (один цикл опроса), порядок колонок CSV
+EXPORT_FIELDS = ('serial', 'total_energy', 'tariff1', 'tariff2', 'tariff3', 'tariff4',
+                 'power', 'voltage', 'current', 'battery')
+
+class ExportSink(abc.ABC):
+    """Base sink with its own bounded buffer, worker thread and batching window.
+
+    Records are (timestamp, {field: value}) tuples, one per poll cycle. A batch
+    that fails to write goes back to the head of the buffer and is retried with
+    backoff; the buffer size and drop policy decide what is discarded.
+    """
+    name = 'sink'
+    RETRY_MIN_SECONDS = 1
+    RETRY_MAX_SECONDS = 300
+    WRITE_TIMEOUT_SECONDS = 10
+
+    def __init__(self, batch_seconds=0, queue_size=1000, drop_policy=DROP_OLDEST):
+        self.batch_seconds = batch_seconds
+        self.queue_size = max(1, queue_size)
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"export-{self.name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def offer(self, record):
+        # Никогда не блокирует: при переполнении буфера применяем drop policy
+        with self._cond:
+            self._buffer.append(record)
+            self._trim()
+            self._cond.notify()
+
+    def _trim(self):
+        excess = len(self._buffer) - self.queue_size
+        if excess <= 0:
+            return
+        for _ in range(excess):
+            if self.drop_policy == DROP_NEWEST:
+                self._buffer.pop()
+            else:
+                self._buffer.popleft()
+        # Предупреждаем о первой потере и далее раз в 100 записей
+        if self.dropped == 0 or self.dropped // 100 != (self.dropped + excess) // 100:
+            logging.warning("%s sink buffer full, dropped %d records so far", self.name, self.dropped + excess)
+        self.dropped += excess
+
+    def _write_pending(self, timeout=None):
+        if timeout is None:
+            timeout = self.WRITE_TIMEOUT_SECONDS
+        if not self._write_lock.acquire(timeout=timeout):
+            return False
+        try:
+            with self._cond:
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if not batch:
+                return True
+            try:
+                self.write(batch, timeout)
+                return True
+            except Exception as e:
+                # Возвращаем пачку в начало буфера, лишнее отбросит drop policy
+                with self._cond:
+                    self._buffer.extendleft(reversed(batch))
+                    self._trim()
+                logging.warning("%s sink write failed, %d records kept for retry: %s", self.name, len(batch), e)
+                return False
+        finally:
+            self._write_lock.release()
+
+    def _run(self):
+        backoff = self.RETRY_MIN_SECONDS
+        while True:
+            with self._cond:
+                while not self._buffer:
+                    self._cond.wait()
+            # Окно батчинга: записи продолжают копиться в буфере
+            if self.batch_seconds > 0:
+                time.sleep(self.batch_seconds)
+            if self._write_pending():
+                backoff = self.RETRY_MIN_SECONDS
+            else:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.RETRY_MAX_SECONDS)
+
+    def flush(self, timeout):
+        # Одна попытка записать всё накопленное за timeout секунд, при остановке add-on
+        if not self._write_pending(max(0.1, timeout)):
+            logging.error("%s sink: %d records lost on shutdown", self.name, len(self._buffer))
+
+    @abc.abstractmethod
+    def write(self, batch, timeout):
+        """Deliver a batch of records within timeout seconds, raise on failure."""
+
+class MqttSink(ExportSink):
+    name = 'mqtt'
+
+    def __init__(self, client, prefix, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+        self.prefix = prefix
+
+    def write(self, batch, timeout):
+        # paho не бросает исключений при обрыве связи: проверяем rc и ждём отправки,
+        # иначе QoS 0 сообщения молча теряются
+        if not self.client.is_connected():
+            raise ConnectionError("MQTT broker not connected")
+        deadline = time.monotonic() + timeout
+        infos = []
+        for _, values in batch:
+            for key, value in values.items():
+                info = self.client.publish(f"{self.prefix}/{key}", value)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    raise ConnectionError(f"publish failed: {mqtt.error_string(info.rc)}")
+                infos.append(info)
+        for info in infos:
+            info.wait_for_publish(max(0.01, deadline - time.monotonic()))
+            if not info.is_published():
+                raise TimeoutError("MQTT publish not completed")
+
+def influx_field(value):
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return repr(float(value))
+
+def influx_line(measurement, ts, values):
+    fields = ','.join(f"{key}={influx_field(value)}" for key, value in values.items())
+    return f"{measurement} {fields} {int(ts * 1e9)}"
+
+class InfluxSink(ExportSink):
+    """InfluxDB line protocol over HTTP(S) (write API URL) or UDP (udp://host:port)."""
+    name = 'influx'
+    UDP_MAX_PAYLOAD = 1400
+
+    def __init__(self, url, token='', measurement='neva_mt124', **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.token = token
+        self.measurement = measurement
+        parts = urllib.parse.urlsplit(url)
+        self._udp_addr = None
+        self._sock = None
+        if parts.scheme == 'udp':
+            self._udp_addr = (parts.hostname, parts.port or 8089)
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, batch, timeout):
+        lines = [influx_line(self.measurement, ts, values) for ts, values in batch]
+        if self._sock is not None:
+            # Несколько строк на датаграмму, но не больше UDP_MAX_PAYLOAD
+            chunk = b''
+            for line in lines:
+                encoded = line.encode() + b'\n'
+                if chunk and len(chunk) + len(encoded) > self.UDP_MAX_PAYLOAD:
+                    self._sock.sendto(chunk, self._udp_addr)
+                    chunk = b''
+                chunk += encoded
+            if chunk:
+                self._sock.sendto(chunk, self._udp_addr)
+            return
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.token:
+            headers['Authorization'] = f"Token {self.token}"
+        request = urllib.request.Request(self.url, data='\n'.join(lines).encode(), headers=headers, method='POST')
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+
+class CsvSink(ExportSink):
+    """Appends one row per poll cycle to a CSV file, rotating it at max_bytes and keeping `backups` old files."""
+    name = 'csv'
+
+    def __init__(self, path, max_bytes=1048576, backups=5, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, batch, timeout):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=('timestamp',) + EXPORT_FIELDS, extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            for ts, values in batch:
+                timestamp = datetime.datetime.fromtimestamp(ts).astimezone().isoformat(timespec='seconds')
+                writer.writerow(dict(values, timestamp=timestamp))
+        if os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+
+class ExportPipeline:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def push(self, values):
+        # Все значения цикла опроса — одна запись с общей меткой времени
+        if not values:
+            return
+        record = (time.time(), dict(values))
+        for sink in self.sinks:
+            sink.offer(record)
+
+    def flush(self, timeout):
+        # Общий срок на все приёмники, чтобы уложиться в таймаут остановки Supervisor
+        deadline = time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.flush(deadline - time.monotonic())
+
+def sink_options(options, name, default_batch_seconds):
+    # Настройки приёмника name_*, по умолчанию общие export_*
+    return {
+        'batch_seconds': options.get(f'{name}_batch_seconds', default_batch_seconds),
+        'queue_size': int(options.get(f'{name}_queue_size', options.get('export_queue_size', 1000))),
+        'drop_policy': options.get(f'{name}_drop_policy', options.get('export_drop_policy', DROP_OLDEST)),
+    }
+
+# Сколько ждать записи накопленного при остановке (Supervisor даёт 10 с до SIGKILL)
+SHUTDOWN_FLUSH_SECONDS = 5
+
+def build_export_pipeline(options, client, prefix):
+    sinks = []
+    if options.get('export_mqtt', True):
+        sinks.append(MqttSink(client, prefix, **sink_options(options, 'mqtt', 0)))
+    if options.get('influx_url'):
+        sinks.append(InfluxSink(options['influx_url'], options.get('influx_token', ''),
+                                **sink_options(options, 'influx', 10)))
+    if options.get('csv_path'):
+        sinks.append(CsvSink(options['csv_path'], int(options.get('csv_max_bytes', 1048576)),
+                             int(options.get('csv_backups', 5)), **sink_options(options, 'csv', 60)))
+    logging.debug("Export sinks: %s", ', '.join(sink.name for sink in sinks))
+    return ExportPipeline(sinks)
+
 # MQTT Discovery конфиги (публикуем один раз)
 def publish_discovery(client, prefix, neva_type):
     logging.debug("Publishing MQTT Discovery configs")
@@ -591,6 +919,9 @@ def main():
     logging.debug("Opening options.json")
     with open('/data/options.json', 'r') as f:
         options = json.load(f)
+    log_level = options.get('log_level', 'info')
+    logging.getLogger().setLevel(log_level.upper())
+    logging.info("Log level: %s", log_level)
     serial_port = options['serial_port']
     initial_baudrate = options['initial_baudrate']
     main_baudrate = options['main_baudrate']
@@ -606,34 +937,62 @@ def main():
     logging.debug("Set timezone to: %s", timezone)
     
     client = mqtt.Client()
+    trace_topic = f"{prefix}/trace/set"
+
+    # Подписка в on_connect, чтобы переживать переподключения к брокеру
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(trace_topic)
+
+    def on_trace_set(client, userdata, msg):
+        try:
+            protocol_trace.configure(msg.payload.decode(errors='ignore'))
+        except Exception as e:
+            # Исключение в колбэке остановило бы сетевой поток paho
+            logging.warning("Invalid %s payload %r: %s", trace_topic, msg.payload, e)
+
+    client.on_connect = on_connect
+    client.message_callback_add(trace_topic, on_trace_set)
     logging.debug("Connecting to MQTT %s:%d", mqtt_host, mqtt_port)
     if mqtt_user and mqtt_pass:
         client.username_pw_set(mqtt_user, mqtt_pass)
     client.connect(mqtt_host, mqtt_port, 60)
     logging.debug("Connected to MQTT at %s:%d", mqtt_host, mqtt_port)
     client.loop_start()
+
+    # Без MQTT-приёмника топики {prefix}/... не обновляются, discovery не публикуем
+    export_mqtt = options.get('export_mqtt', True)
+    exporter = build_export_pipeline(options, client, prefix)
+    exporter.start()
+
+    # Supervisor останавливает add-on через SIGTERM: обработчик только ставит флаг,
+    # накопленное дописывается из основного цикла
+    stopping = threading.Event()
+
+    def on_sigterm(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
     
     discovered = False
-    while True:
+    while not stopping.is_set():
         try:
             logging.debug("Starting poll cycle")
+            protocol_trace.begin_cycle()
             with serial.Serial(serial_port, baudrate=initial_baudrate, bytesize=serial.SEVENBITS, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE, timeout=2) as ser:
                 # Even parity как в C
                 neva_type = open_session(ser)
                 if neva_type != NEVA_124_UNKNOWN:
                     if ack_start(ser, neva_type, main_baudrate):
-                        if not discovered:
+                        if export_mqtt and not discovered:
                             publish_discovery(client, prefix, neva_type)
                             discovered = True
-                        data = {}
+                            # Date release не поддерживается — статичное значение, публикуем один раз
+                            client.publish(f"{prefix}/date_release", "Not supported", retain=True)
+                            logging.debug("Publishing date_release: Not supported")
+                        readings = {}
                         serial_num = get_serial_number_data(ser)
                         if serial_num:
-                            data['serial'] = serial_num
-                            client.publish(f"{prefix}/serial", serial_num)
-                            logging.debug("Publishing serial: %s to %s", serial_num, f"{prefix}/serial")
-                        # Date release не поддерживается, пропускаем или статично "Not supported"
-                        client.publish(f"{prefix}/date_release", "Not supported")
-                        logging.debug("Publishing date_release: Not supported")
+                            readings['serial'] = serial_num
 
                         if neva_type == NEVA_124_6102:
                             tariffs = get_tariffs_6102(ser)
@@ -643,47 +1002,38 @@ def main():
                         if neva_type == NEVA_124_6102:
                             battery = get_resbat_data(ser)
                             if battery is not None:
-                                data['battery'] = battery
-                                client.publish(f"{prefix}/battery", battery)
-                                logging.debug("Publishing battery: %s to %s", battery, f"{prefix}/battery")
+                                readings['battery'] = battery
 
                         if tariffs:
                             total_energy = tariffs['tariff_summ'] / tariffs['energy_divisor']
-                            client.publish(f"{prefix}/total_energy", total_energy)
-                            logging.debug("Publishing total_energy: %s", total_energy)
+                            readings['total_energy'] = total_energy
                             tariff1 = tariffs['tariff1'] / tariffs['energy_divisor']
-                            client.publish(f"{prefix}/tariff1", tariff1)
-                            logging.debug("Publishing tariff1: %s", tariff1)
+                            readings['tariff1'] = tariff1
                             tariff2 = tariffs['tariff2'] / tariffs['energy_divisor']
-                            client.publish(f"{prefix}/tariff2", tariff2)
-                            logging.debug("Publishing tariff2: %s", tariff2)
+                            readings['tariff2'] = tariff2
                             tariff3 = tariffs['tariff3'] / tariffs['energy_divisor']
-                            client.publish(f"{prefix}/tariff3", tariff3)
-                            logging.debug("Publishing tariff3: %s", tariff3)
+                            readings['tariff3'] = tariff3
                             tariff4 = tariffs['tariff4'] / tariffs['energy_divisor']
-                            client.publish(f"{prefix}/tariff4", tariff4)
-                            logging.debug("Publishing tariff4: %s", tariff4)
+                            readings['tariff4'] = tariff4
 
                         power, power_div, mult = get_power_data(ser, neva_type)
                         if power is not None:
                             power_val = (power * mult) / power_div
-                            client.publish(f"{prefix}/power", power_val)
-                            logging.debug("Publishing power: %s", power_val)
+                            readings['power'] = power_val
 
                         if neva_type == NEVA_124_6102:
                             volts, volts_div = get_voltage_data(ser)
                             if volts is not None:
                                 volts_val = volts / volts_div
-                                client.publish(f"{prefix}/voltage", volts_val)
-                                logging.debug("Publishing voltage: %s", volts_val)
+                                readings['voltage'] = volts_val
 
                             amps, amps_div = get_amps_data(ser)
                             if amps is not None:
                                 amps_val = amps / amps_div
-                                client.publish(f"{prefix}/current", amps_val)
-                                logging.debug("Publishing current: %s", amps_val)
+                                readings['current'] = amps_val
                         
-                        print(f"Data published: {data}")
+                        exporter.push(readings)
+                        logging.debug("Queued for export: %s", readings)
                         close_session(ser)
                     else:
                         # ack_start failed, close session to reset meter
@@ -694,12 +1044,17 @@ def main():
                     logging.debug("Unknown meter type, sending close if session open")
                     try:
                         close_session(ser)
-                    except:
+                    except Exception:
                         pass  # Ignore errors on close if not connected
         except Exception as e:
             logging.error("Global error: %s", e)
             # print(f"Error: {e}")
-        time.sleep(interval)
+        stopping.wait(interval)
+
+    logging.info("Stopping, flushing export sinks")
+    exporter.flush(SHUTDOWN_FLUSH_SECONDS)
+    client.disconnect()
+    client.loop_stop()
 
 if __name__ == "__main__":
     main()